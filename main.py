@@ -1,13 +1,19 @@
 import os
 import time
 import argparse
+import io
+import threading
+from collections import deque
+from functools import lru_cache
+from typing import TYPE_CHECKING, Optional
 
-import openai
-import tiktoken
-import dotenv
 from sys import stdout
 import logging
 
+# openai, tiktoken, dotenv, asyncio, sqlite3 and hashlib are imported where they are first needed to keep CLI startup fast
+if TYPE_CHECKING:
+    import openai
+
 DEFAULT_MODEL = "gpt-4o-mini"
 
 ASK_GLOBAL_APIKEY = os.getenv("OPENAI_API_KEY")
@@ -15,33 +21,173 @@ ASK_GLOBAL_MODEL = os.getenv("ASK_GLOBAL_MODEL")
 
 DEBUG = False
 
+# Keep tiktoken's vocab files somewhere that survives reboots instead of the default temp dir
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.expanduser("~/.cache/ask/tiktoken"))
+
 if (not ASK_GLOBAL_APIKEY or not ASK_GLOBAL_MODEL) and os.path.exists(".env"):
+    import dotenv
     dotenv.load_dotenv(".env")
     if not ASK_GLOBAL_APIKEY: ASK_GLOBAL_APIKEY = os.getenv("OPENAI_API_KEY")
     if not ASK_GLOBAL_MODEL: ASK_GLOBAL_MODEL = os.getenv("ASK_GLOBAL_MODEL")
 
+
+def _write_env(apikey, model):
+    # Write to a temp file and rename over .env so a crash never leaves it truncated.
+    # The temp file is private from the start and takes over the mode of an existing .env.
+    tmp = ".env.tmp"
+    mode = os.stat(".env").st_mode & 0o777 if os.path.exists(".env") else 0o600
+    try:
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            os.fchmod(f.fileno(), mode)
+            f.write(f"OPENAI_API_KEY={apikey}\nASK_GLOBAL_MODEL={model}\n")
+        os.replace(tmp, ".env")
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
 if not ASK_GLOBAL_MODEL: ASK_GLOBAL_MODEL = DEFAULT_MODEL
 if not ASK_GLOBAL_APIKEY:
     if not os.path.exists(".env"):
-        open(".env", "w").write(f"OPENAI_API_KEY=sk-xxxxxxxxxx\nASK_GLOBAL_MODEL={ASK_GLOBAL_MODEL}\n")
+        _write_env("sk-xxxxxxxxxx", ASK_GLOBAL_MODEL)
     exit("API Key not found")
 tokenLimit = 128000
+FLUSH_EVERY = 8  # stream deltas written between stdout flushes
+BATCH_ENCODE_MIN = 16  # strings needed before encoding through tiktoken's threaded batch API
+
+
+@lru_cache(maxsize=8)
+def _get_encoding(model):
+    import tiktoken
+    return tiktoken.encoding_for_model(model)
+
+
+def _prefetch_encoding(model):
+    # Errors are left for the foreground call to raise; a background traceback would only garble the output
+    try:
+        _get_encoding(model)
+    except Exception as e:
+        logging.debug(f"Encoding prefetch failed: {e}")
+
+
+_msg_token_cache = {}
+
+# Token counts also persist across invocations, keyed by a hash of (model, role, content)
+TOKEN_CACHE_PATH = os.path.expanduser("~/.cache/ask/tokcount.db")
+TOKEN_CACHE_SIZE = 50000
+TOKEN_CACHE_SLACK = 1000  # rows allowed past TOKEN_CACHE_SIZE before an eviction pass runs
+_touched_token_keys = set()  # hashed keys read from disk whose 'used' time is refreshed on the next store
+
+
+@lru_cache(maxsize=None)
+def _token_db():
+    import sqlite3
+    try:
+        os.makedirs(os.path.dirname(TOKEN_CACHE_PATH), exist_ok=True)
+        # Another ask process holding the lock should not stall this one; the cache is only an optimisation
+        db = sqlite3.connect(TOKEN_CACHE_PATH, timeout=0.1)
+        db.execute("CREATE TABLE IF NOT EXISTS token_counts "
+                   "(key INTEGER PRIMARY KEY, count INTEGER NOT NULL, used REAL NOT NULL)")
+        db.execute("CREATE INDEX IF NOT EXISTS token_counts_used ON token_counts(used)")
+        return db
+    except (OSError, sqlite3.Error) as e:
+        logging.debug(f"Token cache disabled: {e}")
+        return None
+
+
+def _token_key(key):
+    import hashlib
+    # Stable across processes unlike hash(); 64 bits fits SQLite's integer rowid for the fastest lookups
+    digest = hashlib.blake2b("\0".join(key).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+def _load_token_counts(keys):
+    """Fill _msg_token_cache with any of keys found in the on-disk cache."""
+    import sqlite3
+    db = _token_db()
+    if db is None:
+        return
+    hashed = {_token_key(key): key for key in keys}
+    digests = list(hashed)
+    try:
+        for i in range(0, len(digests), 500):
+            chunk = digests[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            for digest, count in db.execute(f"SELECT key, count FROM token_counts WHERE key IN ({marks})", chunk):
+                _msg_token_cache[hashed[digest]] = count
+                _touched_token_keys.add(digest)
+    except sqlite3.Error as e:
+        logging.debug(f"Token cache read failed: {e}")
+
+
+def _store_token_counts(keys):
+    """Persist the counts of keys, refresh entries read since the last store and evict the least recently used."""
+    import sqlite3
+    db = _token_db()
+    if db is None:
+        return
+    now = time.time()
+    try:
+        with db:
+            db.executemany("INSERT OR REPLACE INTO token_counts VALUES (?, ?, ?)",
+                           [(_token_key(key), _msg_token_cache[key], now) for key in keys])
+            db.executemany("UPDATE token_counts SET used = ? WHERE key = ?",
+                           [(now, digest) for digest in _touched_token_keys])
+            (rows,) = db.execute("SELECT count(*) FROM token_counts").fetchone()
+            if rows > TOKEN_CACHE_SIZE + TOKEN_CACHE_SLACK:
+                db.execute("DELETE FROM token_counts WHERE key IN "
+                           "(SELECT key FROM token_counts ORDER BY used DESC LIMIT -1 OFFSET ?)", (TOKEN_CACHE_SIZE,))
+        _touched_token_keys.clear()
+    except sqlite3.Error as e:
+        logging.debug(f"Token cache write failed: {e}")
+
+
+def _over_budget(content, limit):
+    # Text this long is counted as a full budget without being encoded, so the trim loop always drops it.
+    # ~4 chars per token is only an average, so encoding a 4 * limit tail could undercount and keep the message.
+    return bool(limit) and len(content) > limit * 4
+
+
+def _encoded_lengths(model, texts):
+    encoding = _get_encoding(model)
+    # encode_ordinary_batch runs on a thread pool started per call, which only pays off for many strings
+    if len(texts) < BATCH_ENCODE_MIN:
+        return [len(encoding.encode_ordinary(text)) for text in texts]
+    return [len(tokens) for tokens in encoding.encode_ordinary_batch(texts)]
 
 
-def num_tokens_from_messages(messages, model=ASK_GLOBAL_MODEL):
+def _count_message(role, content, model):
+    key = (model, role, content)
+    if key not in _msg_token_cache:
+        encoding = _get_encoding(model)
+        _msg_token_cache[key] = len(encoding.encode_ordinary(role)) + len(encoding.encode_ordinary(content))
+    return _msg_token_cache[key]
+
+
+def num_tokens_from_messages(messages, model=ASK_GLOBAL_MODEL, limit=None):
     """
     @openai-cookbook: https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
     """
-    encoding = tiktoken.encoding_for_model(model)
     tokens_per_message = 3
     tokens_per_name = 1
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
+    keys = [(model, m["role"], m["content"]) for m in messages if not _over_budget(m["content"], limit)]
+    missing = list(set(keys) - _msg_token_cache.keys())
+    if missing:
+        _load_token_counts(missing)
+        missing = [key for key in missing if key not in _msg_token_cache]
+    if missing:
+        counts = _encoded_lengths(model, [text for key in missing for text in key[1:]])
+        for i, key in enumerate(missing):
+            _msg_token_cache[key] = counts[2 * i] + counts[2 * i + 1]
+        _store_token_counts(missing)
+    names = [m["name"] for m in messages if "name" in m]
+    num_tokens = sum(map(_msg_token_cache.__getitem__, keys)) + tokens_per_message * len(messages)
+    if limit:
+        num_tokens += (len(messages) - len(keys)) * limit
+    if names:
+        num_tokens += sum(tokens_per_name + count for count in _encoded_lengths(model, names))
     num_tokens += 3
     return num_tokens
 
@@ -53,55 +199,122 @@ def num_tokens_from_messages(messages, model=ASK_GLOBAL_MODEL):
 # Example: ask --setapikey sk-xxxxxxxxxx --model gpt-4-0125-preview What is the capital of France
 # Example: ask What is the capital of France
 
+_PARSER = argparse.ArgumentParser(description="OpenAI Chatbot")
+_PARSER.add_argument("--token", "-t", help="Set the token for the chatbot", type=str, default=ASK_GLOBAL_APIKEY,
+                     required=False)
+_PARSER.add_argument("--model", "-m", help="Set the model for current chatbot", type=str, default=ASK_GLOBAL_MODEL,
+                     required=False)
+_PARSER.add_argument("--version", "-v", help="Show the version of the chatbot", action="store_true")
+_PARSER.add_argument("--tokenCount", help="Set the token for the chatbot", action="store_true")
+_PARSER.add_argument("--stream", "-s", help="Don't close chat completion and wait for more input",
+                     action="store_true", required=False)
+_PARSER.add_argument("--temperature", "-T", help="Set the temperature for the chatbot", type=float, default=0.7,
+                     required=False)
+_PARSER.add_argument("--tokenLimit", "-l", help="Set the token limit for the chatbot", type=int, default=tokenLimit,
+                     required=False)
+_PARSER.add_argument("--setAPIKey", help="Set the token of openai apikey", type=str, required=False, default="")
+_PARSER.add_argument("--setModel", help="Set the model for all chats", type=str, required=False, default="")
+_PARSER.add_argument("--debug", help="Show all internal debug", action="store_true")
+_PARSER.add_argument("string", help="Questions", type=str, nargs='*')
+
+
 def parser():
-    parser = argparse.ArgumentParser(description="OpenAI Chatbot")
-    parser.add_argument("--token", "-t", help="Set the token for the chatbot", type=str, default=ASK_GLOBAL_APIKEY,
-                        required=False)
-    parser.add_argument("--model", "-m", help="Set the model for current chatbot", type=str, default=ASK_GLOBAL_MODEL,
-                        required=False)
-    parser.add_argument("--version", "-v", help="Show the version of the chatbot", action="store_true")
-    parser.add_argument("--tokenCount", help="Set the token for the chatbot", action="store_true")
-    parser.add_argument("--stream", "-s", help="Don't close chat completion and wait for more input",
-                        action="store_true", required=False)
-    parser.add_argument("--temperature", "-T", help="Set the temperature for the chatbot", type=float, default=0.7,
-                        required=False)
-    parser.add_argument("--tokenLimit", "-l", help="Set the token limit for the chatbot", type=int, default=tokenLimit,
-                        required=False)
-    parser.add_argument("--setAPIKey", help="Set the token of openai apikey", type=str, required=False, default="")
-    parser.add_argument("--setModel", help="Set the model for all chats", type=str, required=False, default="")
-    parser.add_argument("--debug", help="Show all internal debug", action="store_true")
-    parser.add_argument("string", help="Questions", type=str, nargs='*')
-    return parser.parse_args()
-
-
-def ask(client: openai.OpenAI, messages: list, temperature=0.7):
+    return _PARSER.parse_args()
+
+
+async def ask(client: "openai.AsyncOpenAI", messages: deque, temperature=0.7, buffer: Optional[io.StringIO] = None):
     if len(messages) == 0:
         return
-    if len(messages) > 1:
-        while num_tokens_from_messages(messages) + 100 > tokenLimit:
-            messages.pop(0)
-    stream = client.chat.completions.create(model=ASK_GLOBAL_MODEL, messages=messages, stream=True,
-                                            temperature=temperature)
-    buffer = ""
-    for chunk in stream:
-        if chunk.choices[0].delta.content is not None:
-            print(chunk.choices[0].delta.content, end="")
-            stdout.flush()
-            buffer += chunk.choices[0].delta.content
-    print()
-    return buffer
+    # A BPE token covers at least one UTF-8 byte, so the byte length is a cheap upper bound on the token count
+    approx = sum(len(value.encode()) for m in messages for value in m.values()) + 4 * len(messages) + 3
+    if len(messages) > 1 and approx + 100 > tokenLimit:
+        total = num_tokens_from_messages(messages, ASK_GLOBAL_MODEL, tokenLimit)
+        # Drop the oldest turns after the system prompt so the server-side prompt cache can reuse the prefix
+        start = 1 if messages[0]["role"] == "system" else 0
+        while len(messages) > 1 and total + 100 > tokenLimit:
+            index = start if len(messages) - start > 1 else 0
+            message = messages[index]
+            if _over_budget(message["content"], tokenLimit):
+                total -= tokenLimit + 3
+            else:
+                total -= _count_message(message["role"], message["content"], ASK_GLOBAL_MODEL) + 3
+            del messages[index]
+    stream = await client.chat.completions.create(model=ASK_GLOBAL_MODEL, messages=list(messages), stream=True,
+                                                  temperature=temperature)
+    # The caller may pass a buffer to reuse across turns; it is cleared before each reply
+    if buffer is None:
+        buffer = io.StringIO()
+    buffer.seek(0)
+    buffer.truncate()
+    deltas = 0
+    async for chunk in stream:
+        content = chunk.choices[0].delta.content
+        if content is not None:
+            buffer.write(content)
+            stdout.write(content)
+            deltas += 1
+            if deltas % FLUSH_EVERY == 0:
+                stdout.flush()
+    stdout.write("\n")
+    stdout.flush()
+    return buffer.getvalue()
+
+
+def chat(args, prompt):
+    import asyncio
+    import httpx
+    import openai
+    # One pooled HTTP/2 connection is kept alive across turns so --stream sessions skip the TCP/TLS handshake
+    http_client = httpx.AsyncClient(http2=True,
+                                    limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=300))
+    client = openai.AsyncOpenAI(api_key=args.token, http_client=http_client)
+    buffer = io.StringIO()
+    # A single runner keeps one event loop (and so one connection pool) across turns, while input() runs
+    # outside it so Ctrl-C at the prompt gets Python's default SIGINT handling
+    with asyncio.Runner() as runner:
+        try:
+            if args.stream:
+                print("Type 'exit' to quit.")
+                userchat = deque([
+                    {"role": "system",
+                     "content": "You are a cute cat running in a command line interface. The user can chat with you and the conversation can be continued."},
+                    {"role": "user", "content": prompt}
+                ])
+                response = runner.run(ask(client, userchat, args.temperature, buffer))
+                userchat.append({"role": "assistant", "content": response})
+                while True:
+                    userInput = input()
+                    if userInput == "exit":
+                        break
+                    userchat.append({"role": "user", "content": userInput})
+                    response = runner.run(ask(client, userchat, buffer=buffer))
+                    userchat.append({"role": "assistant", "content": response})
+            else:
+                userchat = deque([
+                    {"role": "system",
+                     "content": "You are a cute cat runs in a command line interface and you can only respond once to the user. Do not ask any questions in your response."},
+                    {"role": "user", "content": prompt}
+                ])
+                response = runner.run(ask(client, userchat, args.temperature, buffer))
+                userchat.append({"role": "assistant", "content": response})
+        finally:
+            runner.run(client.close())
 
 
 def main():
     global ASK_GLOBAL_APIKEY, ASK_GLOBAL_MODEL, DEBUG
     args = parser()
+    prompt = " ".join(args.string)
+    # Only --stream sessions can grow past the byte-length fast path in ask(), so only they warm the tokenizer
+    if args.stream and not (args.setAPIKey or args.setModel or args.tokenCount or (args.version and not args.debug)):
+        threading.Thread(target=_prefetch_encoding, args=(ASK_GLOBAL_MODEL,), daemon=True).start()
     if args.debug:
         DEBUG = True
         logging.basicConfig(level=logging.DEBUG)
     if args.setAPIKey or args.setModel:
         if args.setModel: ASK_GLOBAL_MODEL = args.setModel
         if args.setAPIKey: ASK_GLOBAL_APIKEY = args.setAPIKey
-        open(".env", "w").write(f"OPENAI_API_KEY={ASK_GLOBAL_APIKEY}\nASK_GLOBAL_MODEL={ASK_GLOBAL_MODEL}\n")
+        _write_env(ASK_GLOBAL_APIKEY, ASK_GLOBAL_MODEL)
         print("Remember to upgrade tiktoken with newer model if you use stream")
         return
     if args.version or DEBUG:
@@ -111,33 +324,9 @@ def main():
         print("Token Limit: ", tokenLimit)
         if not DEBUG: return  # Exit if not debug
     if args.tokenCount:
-        print(num_tokens_from_messages([{"role": "user", "content": " ".join(args.string)}]))
+        print(num_tokens_from_messages([{"role": "user", "content": prompt}]))
         return
-    client = openai.OpenAI(api_key=args.token)
-    if args.stream:
-        print("Type 'exit' to quit.")
-        userchat = [
-            {"role": "system",
-             "content": "You are a cute cat running in a command line interface. The user can chat with you and the conversation can be continued."},
-            {"role": "user", "content": " ".join(args.string)}
-        ]
-        response = ask(client, userchat, args.temperature)
-        userchat.append({"role": "assistant", "content": response})
-        while True:
-            userInput = input()
-            if userInput == "exit":
-                break
-            userchat.append({"role": "user", "content": userInput})
-            response = ask(client, userchat)
-            userchat.append({"role": "assistant", "content": response})
-    else:
-        userchat = [
-            {"role": "system",
-             "content": "You are a cute cat runs in a command line interface and you can only respond once to the user. Do not ask any questions in your response."},
-            {"role": "user", "content": " ".join(args.string)}
-        ]
-        response = ask(client, userchat, args.temperature)
-        userchat.append({"role": "assistant", "content": response})
+    chat(args, prompt)
 
 
 if __name__ == '__main__':